@@ -2,15 +2,28 @@
 Analyzes GPX files to extract maximum speed limits along a route using OpenStreetMap data via the Overpass API, and visualizes the results on an interactive map
 """
 
+from contextlib import nullcontext
 from datetime import datetime
-import time
+from functools import lru_cache
+from itertools import chain
 import argparse
+import asyncio
+import re
+import sys
+import xml.etree.ElementTree as ET
+import aiohttp
+from aiolimiter import AsyncLimiter
+from branca.element import MacroElement
+from diskcache import Cache
 import folium
-from folium.plugins import MarkerCluster
-import gpxpy
-import overpy
-import requests
+from folium.plugins import FastMarkerCluster
+from folium.template import Template
 import numpy as np
+from scipy.spatial import cKDTree
+try:
+    import orjson
+except ImportError:
+    import json as orjson
 
 # OSM speed code mapping (France-specific)
 SPEED_CODE_MAPPING = {
@@ -20,6 +33,49 @@ SPEED_CODE_MAPPING = {
     'FR:motorway': 130
 }
 
+# Leading number of a maxspeed value such as '50' or '30 mph'
+SPEED_RE = re.compile(r'^\s*(\d+)')
+
+# Mean Earth radius in meters
+EARTH_RADIUS = 6371000
+
+OVERPASS_URL = 'https://overpass-api.de/api/interpreter'
+
+# Roads and fuel stations are fetched by tiles of TILE_SIZE degrees along the route,
+# padded by TILE_MARGIN degrees (~100 m)
+TILE_SIZE = 0.1
+TILE_MARGIN = 0.001
+
+# A point gets the max speed of the nearest road within MATCH_RADIUS meters,
+# roads being sampled every WAY_SAMPLE_STEP meters
+MATCH_RADIUS = 30
+WAY_SAMPLE_STEP = 10
+
+# Overpass allows very few concurrent requests per IP: keep them few and spaced out
+OVERPASS_CONCURRENCY = 2
+OVERPASS_INTERVAL = 1.2
+
+# Builds a fuel station marker from a [lat, lon, popup, color] row, sharing one icon per color
+STATION_MARKER_CALLBACK = """
+(function () {
+    var icons = {};
+    return function (row) {
+        var color = row[3];
+        if (!(color in icons)) {
+            icons[color] = L.AwesomeMarkers.icon({icon: 'tint', prefix: 'fa', iconColor: 'white', markerColor: color});
+        }
+        return L.marker(new L.LatLng(row[0], row[1]), {icon: icons[color]}).bindPopup(row[2]);
+    };
+})()"""
+
+# Number of progress lines buffered before writing them to stdout
+PRINT_FLUSH_EVERY = 10
+
+# On-disk cache of Overpass results, kept for 30 days
+CACHE_DIR = '.overpass_cache'
+CACHE_EXPIRE = 30 * 24 * 3600
+CACHE_MISS = object()
+
 def parse_arguments():
     """ Parse command line arguments """
     parser = argparse.ArgumentParser(
@@ -27,186 +83,298 @@ def parse_arguments():
     )
     parser.add_argument('--file', '-f', required=True, help="Path to the GPX file")
     parser.add_argument('--limit-speed', '-l', type=int, default=110, help="Speed threshold in km/h (default: 110)")
-    parser.add_argument('--max-points', '-m', type=int, default=400, help="Maximum number of GPS points to query (default: 400)")
+    parser.add_argument('--max-points', '-m', type=int, default=400, help="Maximum number of GPS points matched to roads (default: 400)")
+    parser.add_argument('--no-cache', action='store_true', help="Ignore the on-disk cache of Overpass results")
+    parser.add_argument('--no-stations', action='store_true', help="Do not show fuel stations on the map")
     return parser.parse_args()
 
 def load_gpx_points(filepath):
-    """ Load GPS points from a GPX file """
-    with open(filepath, 'r', encoding='utf-8') as f:
-        gpx = gpxpy.parse(f)
-    points = [(pt.latitude, pt.longitude)
-              for track in gpx.tracks
-              for segment in track.segments
-              for pt in segment.points]
-    return points
+    """ Load GPS points from a GPX file as an (N, 2) array of (lat, lon) """
+    points = []
+    # Stream track points rather than building the whole document tree
+    for _, elem in ET.iterparse(filepath, events=('end',)):
+        if elem.tag.rsplit('}', 1)[-1] == 'trkpt':
+            points.append((float(elem.attrib['lat']), float(elem.attrib['lon'])))
+            elem.clear()
+    return np.array(points, dtype=np.float64).reshape(-1, 2)
+
+def get_cumulative_distances(points):
+    """ Compute the distance in meters travelled from the first point to each point (haversine) """
+    lat, lon = np.radians(points).T
+    dlat = np.diff(lat)
+    dlon = np.diff(lon)
+    a = np.sin(dlat / 2) ** 2 + np.cos(lat[:-1]) * np.cos(lat[1:]) * np.sin(dlon / 2) ** 2
+    d = 2 * EARTH_RADIUS * np.arcsin(np.sqrt(a))
+    return np.concatenate(([0.0], np.cumsum(d)))
 
 def get_sample_points(points, max_points):
-    """ Evenly sample GPS points if there are too many """
+    """ Sample GPS points evenly spaced along the route if there are too many """
     if len(points) <= max_points:
         return points
-    indices = np.linspace(0, len(points) - 1, max_points, dtype=int)
-    return [points[i] for i in indices]
+    distances = get_cumulative_distances(points)
+    targets = np.linspace(0, distances[-1], max_points)
+    # Points closer than the sampling step collapse onto the same index
+    indices = np.unique(np.searchsorted(distances, targets))
+    return points[indices]
+
+class OverpassClient:
+    """ Overpass API client sharing one HTTP session, with capped concurrency and request rate """
+
+    def __init__(self):
+        self.session = None
+        self.slots = asyncio.Semaphore(OVERPASS_CONCURRENCY)
+        self.limiter = AsyncLimiter(1, OVERPASS_INTERVAL)
 
-def query_max_speed(latitude, longitude):
-    """ Query Overpass API to get the max speed limit at a location """
+    async def __aenter__(self):
+        self.session = aiohttp.ClientSession()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.session.close()
+
+    async def query(self, query, timeout):
+        """ Run an Overpass query and return the decoded JSON response """
+        async with self.slots, self.limiter:  # avoid Overpass rate limiting
+            async with self.session.post(
+                OVERPASS_URL,
+                data={'data': query},
+                timeout=aiohttp.ClientTimeout(total=timeout)
+            ) as response:
+                response.raise_for_status()
+                return orjson.loads(await response.read())
+
+def get_route_tiles(points):
+    """ List the tiles of a fixed TILE_SIZE grid crossed by the route """
+    cells = np.unique(np.floor(points / TILE_SIZE).astype(int), axis=0)
+    return [(int(i), int(j)) for i, j in cells]
+
+def get_tile_bbox(tile):
+    """ Calculate the bounding box of a tile, padded so roads just across its border are included """
+    i, j = tile
+    return (round(i * TILE_SIZE - TILE_MARGIN, 6), round(j * TILE_SIZE - TILE_MARGIN, 6),
+            round((i + 1) * TILE_SIZE + TILE_MARGIN, 6), round((j + 1) * TILE_SIZE + TILE_MARGIN, 6))
+
+async def query_tile(client, tile):
+    """ Query Overpass API for roads with a max speed and fuel stations within a tile (None if the query failed) """
+    south, west, north, east = get_tile_bbox(tile)
     query = f"""
-    [out:json][timeout:60];
-    way(around:30,{latitude},{longitude})['highway']['maxspeed'];
-    out tags;
+    [out:json][timeout:180];
+    (
+      way['highway']['maxspeed']( {south}, {west}, {north}, {east} );
+      node['amenity'='fuel']['fuel:octane_98']( {south}, {west}, {north}, {east} );
+      node['amenity'='fuel']['fuel:octane_95']( {south}, {west}, {north}, {east} );
+    );
+    out tags geom;
     """
     try:
-        response = requests.post(
-            'https://overpass-api.de/api/interpreter',
-            data={'data': query},
-            timeout=60
-        )
-        if response.status_code == 200:
-            data = response.json()
-            speeds = [el['tags']['maxspeed'] for el in data['elements'] if 'maxspeed' in el.get('tags', {})]
-            return speeds[0] if speeds else None
+        data = await client.query(query, timeout=180)
     except Exception as e:
         print(f"API Error: {e}")
-    return None
+        return None
+    # Overpass reports timeouts and memory exhaustion as a remark next to partial (or no) elements
+    if 'remark' in data:
+        print(f"API Error: {data['remark']}")
+        return None
+    ways = {}
+    stations = {}
+    for el in data['elements']:
+        tags = el.get('tags', {})
+        if el['type'] == 'way':
+            ways[el['id']] = (tags['maxspeed'], [(pt['lat'], pt['lon']) for pt in el['geometry']])
+            continue
+        has_sp95 = tags.get('fuel:octane_95') == 'yes'
+        has_sp98 = tags.get('fuel:octane_98') == 'yes'
+        stations[el['id']] = {
+            'lat': float(el['lat']),
+            'lon': float(el['lon']),
+            'sp95': has_sp95,
+            'sp98': has_sp98,
+            'name': tags.get('name', 'Station-service')
+        }
+    return {'ways': ways, 'stations': stations}
+
+async def fetch_route_data(points, cache=None):
+    """ Fetch roads with a max speed and fuel stations along the route, tile by tile """
+    tiles = get_route_tiles(points)
+    print(f"⏳ Querying Overpass API ({len(tiles)} tiles)...")
+    ways = {}
+    stations = {}
+    pending = []
+    for tile in tiles:
+        value = CACHE_MISS if cache is None else cache.get(('tile',) + tile, default=CACHE_MISS)
+        if value is CACHE_MISS:
+            pending.append(tile)
+        else:
+            ways.update(value['ways'])
+            stations.update(value['stations'])
 
+    async with OverpassClient() as client:
+        tasks = [asyncio.create_task(query_tile(client, tile)) for tile in pending]
+        for i, (tile, task) in enumerate(zip(pending, tasks)):
+            tile_data = await task
+            if tile_data is None:
+                # Failed queries are not cached: roads of this tile stay unknown
+                print(f"[{i+1}/{len(pending)}] Tile {get_tile_bbox(tile)} → Failed")
+                continue
+            print(f"[{i+1}/{len(pending)}] Tile {get_tile_bbox(tile)} → {len(tile_data['ways'])} roads")
+            if cache is not None:
+                cache.set(('tile',) + tile, tile_data, expire=CACHE_EXPIRE)
+            # Roads and stations crossing a tile border are returned by both tiles
+            ways.update(tile_data['ways'])
+            stations.update(tile_data['stations'])
+    return list(ways.values()), list(stations.values())
+
+def sample_ways(ways):
+    """ Sample points every WAY_SAMPLE_STEP meters along the ways, with the index of the way of each point """
+    sizes = np.fromiter((len(geometry) for _, geometry in ways), dtype=np.intp, count=len(ways))
+    nodes = np.array(list(chain.from_iterable(geometry for _, geometry in ways)), dtype=np.float64).reshape(-1, 2)
+    if len(nodes) < 2:
+        return np.empty((0, 2)), np.empty(0, dtype=np.intp)
+    way_of_node = np.repeat(np.arange(len(ways)), sizes)
+    # All ways are laid end to end: drop the segments joining a way to the next one
+    starts = np.flatnonzero(way_of_node[:-1] == way_of_node[1:])
+    lengths = np.diff(get_cumulative_distances(nodes))[starts]
+    # Split each segment into pieces and keep the middle of each piece
+    counts = np.maximum(1, np.ceil(lengths / WAY_SAMPLE_STEP)).astype(np.intp)
+    segments = np.repeat(starts, counts)
+    offsets = np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+    fractions = ((offsets + 0.5) / np.repeat(counts, counts))[:, None]
+    coords = nodes[segments] + (nodes[segments + 1] - nodes[segments]) * fractions
+    return coords, way_of_node[segments]
+
+@lru_cache(maxsize=512)
 def parse_speed(val):
     """ Parse speed value from Overpass response into integer km/h """
-    try:
-        if val in SPEED_CODE_MAPPING:
-            return SPEED_CODE_MAPPING[val]
-        return int(val.split()[0])
-    except Exception as _:
+    if val is None:
         return None
+    if val in SPEED_CODE_MAPPING:
+        return SPEED_CODE_MAPPING[val]
+    match = SPEED_RE.match(val)
+    return int(match.group(1)) if match else None
 
-def collect_speed_data(points, limit_speed):
-    """ Collect max speed data for each point """
+def flush_lines(lines):
+    """ Write buffered output lines to stdout at once and empty the buffer """
+    if lines:
+        sys.stdout.write('\n'.join(lines) + '\n')
+        sys.stdout.flush()
+        lines.clear()
+
+def project(points, ref_lat):
+    """ Project (lat, lon) points onto a plane in meters (equirectangular around ref_lat, in radians) """
+    lat, lon = np.radians(points).T
+    return EARTH_RADIUS * np.column_stack((lon * np.cos(ref_lat), lat))
+
+def collect_speed_data(points, ways, limit_speed):
+    """ Collect max speed data for each point from the nearest road """
     results = []
-    print('⏳ Querying Overpass API...')
-    for i, (lat, lon) in enumerate(points):
-        max_speed = query_max_speed(lat, lon)
+    coords, owners = sample_ways(ways)
+    max_speeds = np.full(len(points), None, dtype=object)
+    if len(coords):
+        ref_lat = np.radians(points[:, 0].mean())
+        tree = cKDTree(project(coords, ref_lat))
+        # Only match roads within MATCH_RADIUS meters, like the former around:30 Overpass filter
+        _, indices = tree.query(project(points, ref_lat), k=1, distance_upper_bound=MATCH_RADIUS)
+        found = indices < len(coords)
+        way_speeds = np.array([speed for speed, _ in ways], dtype=object)
+        max_speeds[found] = way_speeds[owners[indices[found]]]
+
+    lines = []
+    for i, ((lat, lon), max_speed) in enumerate(zip(points, max_speeds)):
+        speed_val = parse_speed(max_speed)
         if max_speed is not None:
-            speed_val = parse_speed(max_speed)
             if speed_val is not None and speed_val >= limit_speed:
-                print(f"\033[91m[{i+1}/{len(points)}] ({lat:.5f}, {lon:.5f}) → {speed_val} km/h ⚠️\033[0m")
+                lines.append(f"\033[91m[{i+1}/{len(points)}] ({lat:.5f}, {lon:.5f}) → {speed_val} km/h ⚠️\033[0m")
             else:
-                print(f"[{i+1}/{len(points)}] ({lat:.5f}, {lon:.5f}) → {speed_val} km/h")
+                lines.append(f"[{i+1}/{len(points)}] ({lat:.5f}, {lon:.5f}) → {speed_val} km/h")
         else:
-            print(f"[{i+1}/{len(points)}] ({lat:.5f}, {lon:.5f}) → Unknown speed")
+            lines.append(f"[{i+1}/{len(points)}] ({lat:.5f}, {lon:.5f}) → Unknown speed")
 
-        results.append({'lat': lat, 'lon': lon, 'maxspeed': max_speed})
-        time.sleep(1.2)  # avoid Overpass rate limiting
+        results.append({'lat': lat, 'lon': lon, 'maxspeed': max_speed, 'parsed': speed_val})
+        if len(lines) >= PRINT_FLUSH_EVERY:
+            flush_lines(lines)
+    flush_lines(lines)
     return results
 
-def get_bounding_box(points):
-    """ Calculate bounding box from GPS points """
-    lats = [p[0] for p in points]
-    lons = [p[1] for p in points]
-    return min(lats), min(lons), max(lats), max(lons)
-
-def get_fuel_stations(bbox):
-    """ Query Overpass API for fuel stations within a bounding box """
-    south, west, north, east = bbox
-    query = f"""
-    [out:json][timeout:60];
-    (
-      node['amenity'='fuel']['fuel:octane_98']( {south}, {west}, {north}, {east} );
-      node['amenity'='fuel']['fuel:octane_95']( {south}, {west}, {north}, {east} );
-    );
-    out center;
-    """
-    api = overpy.Overpass()
-    result = api.query(query)
-    stations = []
-    for node in result.nodes:
-        has_sp95 = node.tags.get('fuel:octane_95') == 'yes'
-        has_sp98 = node.tags.get('fuel:octane_98') == 'yes'
-        stations.append({
-            'lat': float(node.lat),
-            'lon': float(node.lon),
-            'sp95': has_sp95,
-            'sp98': has_sp98,
-            'name': node.tags.get('name', 'Station-service')
-        })
-    return stations
-
 def add_fuel_stations_to_map(speed_map, stations):
-    """ Add fuel stations to the map with markers """
+    """ Add fuel stations to the map as markers built and clustered on the browser side """
+    data = []
     for station in stations:
         popup = f"{station['name']}<br>"
         popup += "✅ SP98<br>" if station["sp98"] else "❌ SP98<br>"
         popup += "✅ SP95" if station["sp95"] else "❌ SP95"
         color = "green" if station["sp95"] and station["sp98"] else "orange"
-        folium.Marker(
-            location=[station['lat'], station['lon']],
-            popup=popup,
-            icon=folium.Icon(color=color, icon='tint', prefix='fa')
-        ).add_to(speed_map)
+        data.append([station['lat'], station['lon'], popup, color])
+    if data:
+        FastMarkerCluster(data, callback=STATION_MARKER_CALLBACK, name='Fuel stations').add_to(speed_map)
+
+class SpeedSegments(MacroElement):
+    """ Draw every route run from a single script rather than one folium.PolyLine each """
+    _template = Template("""
+        {% macro script(this, kwargs) %}
+            var {{ this.get_name() }} = {
+            {%- for key, group in this.groups.items() %}
+                {{ key|tojson }}: {{ group.get_name() }},
+            {%- endfor %}
+            };
+            {{ this.runs|tojson }}.forEach(function(r) {
+                L.polyline(r[0], {color: r[1], weight: 4})
+                    .bindPopup("Maxspeed: " + r[2])
+                    .addTo({{ this.get_name() }}[r[3]]);
+            });
+        {% endmacro %}
+    """)
+
+    def __init__(self, groups, runs):
+        """ groups maps a key to its FeatureGroup, runs are [locations, color, label, key] """
+        super().__init__()
+        self._name = 'SpeedSegments'
+        self.groups = groups
+        self.runs = runs
 
-def build_speed_map(points, results, limit_speed):
+def build_speed_map(points, results, limit_speed, stations):
     """ Build an interactive map with speed info """
     start_lat, start_lon = points[0]
     speed_map = folium.Map(location=[start_lat, start_lon], zoom_start=11)
 
-    bounding_box = get_bounding_box(points)
-    stations = get_fuel_stations(bounding_box)
     add_fuel_stations_to_map(speed_map, stations)
 
-    cluster = MarkerCluster()
-
     # Layer groups
-    fast_group = folium.FeatureGroup(name=f"Speed ≥ {limit_speed} km/h", show=True)
-    slow_group = folium.FeatureGroup(name=f"Speed < {limit_speed} km/h", show=True)
-    unknown_group = folium.FeatureGroup(name='Unknown speed', show=True)
+    groups = {
+        'fast': folium.FeatureGroup(name=f"Speed ≥ {limit_speed} km/h", show=True),
+        'slow': folium.FeatureGroup(name=f"Speed < {limit_speed} km/h", show=True),
+        'unknown': folium.FeatureGroup(name='Unknown speed', show=True)
+    }
 
-    # Add markers
-    for pt in results:
-        speed_raw = pt['maxspeed']
-        color = 'gray'
-        label = 'Unknown'
-        try:
-            speed_val = parse_speed(speed_raw)
-            if speed_val is not None:
-                label = f"{speed_val} km/h"
-                color = 'red' if speed_val >= limit_speed else 'blue'
-        except Exception as _:
-            label = str(speed_raw)
-        folium.Marker(
-            location=[pt['lat'], pt['lon']],
-            popup=f"Maxspeed: {label}",
-            icon=folium.Icon(color=color)
-        ).add_to(cluster)
-
-    # Draw lines
+    # Draw lines, merging contiguous segments sharing the same speed into a single run
+    runs = []
     for i in range(len(results) - 1):
         lat1, lon1 = results[i]['lat'], results[i]['lon']
         lat2, lon2 = results[i+1]['lat'], results[i+1]['lon']
-        s1 = parse_speed(results[i]['maxspeed'])
-        s2 = parse_speed(results[i+1]['maxspeed'])
-        seg_speed = max(filter(None, [s1, s2]), default=None)
+        s1 = results[i]['parsed']
+        s2 = results[i+1]['parsed']
+        seg_speed = s1 if s2 is None else s2 if s1 is None else (s1 if s1 > s2 else s2)
 
         color = 'gray'
         label = 'Unknown speed'
-        group = unknown_group
+        group = 'unknown'
         if seg_speed is not None:
             label = f"{seg_speed} km/h"
             if seg_speed >= limit_speed:
                 color = 'red'
-                group = fast_group
+                group = 'fast'
             else:
                 color = 'blue'
-                group = slow_group
+                group = 'slow'
 
-        folium.PolyLine(
-            [(lat1, lon1), (lat2, lon2)],
-            color=color,
-            weight=4,
-            popup=folium.Popup(f"Maxspeed: {label}", show=False)
-        ).add_to(group)
+        if runs and runs[-1][2] == label:
+            runs[-1][0].append([lat2, lon2])
+        else:
+            runs.append([[[lat1, lon1], [lat2, lon2]], color, label, group])
 
     # Add everything to map
-    #cluster.add_to(speed_map)
-    fast_group.add_to(speed_map)
-    slow_group.add_to(speed_map)
-    unknown_group.add_to(speed_map)
+    for group in groups.values():
+        group.add_to(speed_map)
+    SpeedSegments(groups, runs).add_to(speed_map)
     folium.LayerControl(collapsed=False).add_to(speed_map)
 
     # Legend
@@ -243,8 +411,10 @@ def main():
     print(f"Total GPS points: {len(points)}")
     sampled_points = get_sample_points(points, max_points)
     print(f"Sampled {len(sampled_points)} points")
-    results = collect_speed_data(sampled_points, limit_speed)
-    speed_map = build_speed_map(sampled_points, results, limit_speed)
+    with nullcontext() if args.no_cache else Cache(CACHE_DIR) as cache:
+        ways, stations = asyncio.run(fetch_route_data(sampled_points, cache))
+    results = collect_speed_data(sampled_points, ways, limit_speed)
+    speed_map = build_speed_map(sampled_points, results, limit_speed, [] if args.no_stations else stations)
     timestamp = datetime.now().strftime('%Y%m%d_%H%M%S')
     filename = f"speed_map_{timestamp}.html"
     speed_map.save(filename)